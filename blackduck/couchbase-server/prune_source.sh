@@ -45,27 +45,23 @@ rm -rf goproj/src/github.com/couchbase/docloader/examples
 rm -rf goproj/src/github.com/couchbase/indexing/secondary/docs
 rm -f tlm/cmake/Modules/rebar
 
-# General-purpose removal of test data, examples, docs, etc.
-find . -name analytics -prune -o -type d -name test\* -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name testdata -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name gtest -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name testing -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name \*tests -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name data -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name docs -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name example -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name examples -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name samples -print0 | xargs -0 rm -rf
-find . -name analytics -prune -o -type d -name benchmarks -print0 | xargs -0 rm -rf
-
 # godeps-specific pruning (hopefully eliminated after switching entirely to Go modules)
 rm -rf godeps/src/golang.org/x/tools/cmd/heapview/client
 
-# Remove all msvc, vcs* window projects
-WIN='example *msvc* *vcproj* *vcxproj* visual vstudio dot_net_example example csharp vc7ide'
-for windir in ${WIN}; do
-    find . -name analytics -prune -o -type d -name "$windir" -print0 | xargs -0 rm -rf
-done
+# General-purpose removal of test data, examples, docs, etc., along with
+# all msvc, vcs* window projects. This is a single pass over the tree;
+# matching directories are pruned rather than descended into, so the
+# paths found are disjoint and can safely be removed in parallel,
+# in batches of 16 per rm.
+find . -name analytics -prune -o -type d \( \
+        -name test\* -o -name testdata -o -name gtest -o -name testing \
+        -o -name \*tests -o -name data -o -name docs -o -name example \
+        -o -name examples -o -name samples -o -name benchmarks \
+        -o -name \*msvc\* -o -name \*vcproj\* -o -name \*vcxproj\* \
+        -o -name visual -o -name vstudio -o -name dot_net_example \
+        -o -name csharp -o -name vc7ide \
+    \) -prune -print0 \
+    | xargs -0 -r -n 16 -P "$(nproc)" rm -rf
 
 # Horrible annoying hacks below!
 # Black Duck sometimes gives dependency components new names. This screws up
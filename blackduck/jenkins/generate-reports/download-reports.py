@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import json
 import logging
 import os
+import random
+import requests
+import shutil
 import sys
+import tempfile
 import time
 import zipfile
 
 from blackduck.HubRestApi import HubInstance
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger('blackduck/download-reports')
 logger.setLevel(logging.DEBUG)
@@ -22,7 +28,8 @@ class FailedDownload(Exception):
     pass
 
 class ReportsDownloader:
-    def __init__(self, product, version, bld_num, cred_file, output_dir):
+    def __init__(self, product, version, bld_num, cred_file, output_dir,
+                 report_timeout=1200):
         """
         Connects to Hub and initializes Project and Version
         """
@@ -32,12 +39,21 @@ class ReportsDownloader:
         self.prefix = f"{product}-{version}-{bld_num}"
         self.output_dir = Path(output_dir).resolve()
         self.tmp_zip = self.output_dir / "tmp.zip"
+        self.report_timeout = report_timeout
 
         # Connect to Black Duck
         creds = json.load(cred_file)
         logger.info(f"Connecting to Black Duck hub {creds['url']}")
         self.hub = HubInstance(creds["url"], creds["username"], creds["password"], insecure=True)
 
+        # Scan downloads (from several threads at once) and report polls
+        # all go through this session, so they share a pool of keep-alive
+        # connections rather than each paying for a new TLS handshake
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
         self.product = self.hub.get_project_by_name(product)
         if not self.product:
             raise Exception(f"Unknown product {product}")
@@ -45,6 +61,21 @@ class ReportsDownloader:
         if not self.version:
             raise Exception(f"Unknown version {version} for product {product}")
 
+    def stream_report(self, report_id):
+        """
+        Requests a report's .zip from Hub without reading the response
+        body, so the caller can stream it to disk. Same request as
+        HubInstance.download_report()
+        """
+
+        url = f"{self.hub.get_urlbase()}/api/reports/{report_id}"
+        headers = self.hub.get_headers()
+        headers.update({'Content-Type': 'application/zip', 'Accept': 'application/zip'})
+        return self.session.get(
+            url, headers=headers, stream=True,
+            verify=not self.hub.config['insecure']
+        )
+
     def download_report(self, report_name, location):
         """
         Waits for a specified report to be available, then downloads all
@@ -54,21 +85,32 @@ class ReportsDownloader:
         report_id = location.split("/")[-1]
         logger.info(f"Downloading {report_name}")
         logger.debug(f"Report ID is {report_id}")
-        retries = 200
-        while retries > 0:
-            response = self.hub.download_report(report_id)
-            if response.status_code != 200:
-                logger.debug(f"Report not ready yet, retrying #{retries}")
-                time.sleep(6)
-                retries -= 1
-                continue
-            logger.debug(f"Writing {report_name} to {self.tmp_zip}")
-            with self.tmp_zip.open("wb") as f:
-                f.write(response.content)
-            self.unpack_report(report_name)
-            return
-
-        raise Exception(f"Failed to retrieve {report_name} {report_id} after many retries!")
+        # Poll with capped exponential backoff (1s, 2s, 4s, ... 30s) plus
+        # a little jitter, so small reports are picked up promptly while
+        # large ones are still waited on for up to report_timeout seconds
+        deadline = time.monotonic() + self.report_timeout
+        attempt = 0
+        while True:
+            response = self.stream_report(report_id)
+            if response.status_code == 200:
+                break
+            response.close()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception(
+                    f"Failed to retrieve {report_name} {report_id} "
+                    f"after {self.report_timeout} seconds!"
+                )
+            delay = min(30, 2 ** attempt) + random.uniform(0, 0.5)
+            attempt += 1
+            logger.debug(f"Report not ready yet, retrying in {delay:.1f} seconds")
+            time.sleep(min(delay, remaining))
+
+        logger.debug(f"Writing {report_name} to {self.tmp_zip}")
+        with response, self.tmp_zip.open("wb") as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+        self.unpack_report(report_name)
 
     def unpack_report(self, report_name):
         """
@@ -94,7 +136,7 @@ class ReportsDownloader:
                 logger.debug(f"Writing {out_file}")
                 with out_file.open("wb") as out:
                     with z.open(entry) as content:
-                        out.write(content.read())
+                        shutil.copyfileobj(content, out, 1024 * 1024)
 
         self.tmp_zip.unlink()
 
@@ -127,6 +169,29 @@ class ReportsDownloader:
         self.notices_location = response.headers['Location']
         logger.debug(f"Notices location is {self.notices_location}")
 
+    def download_scan(self, url, staging_dir):
+        """
+        Downloads a single .bdio scan to a temporary file in staging_dir,
+        and returns the path to that file
+        """
+
+        with self.session.get(
+            url, headers=self.hub.get_headers(), stream=True,
+            verify=not self.hub.config['insecure']
+        ) as response:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile(
+                dir=staging_dir, suffix=".bdio", delete=False
+            ) as f:
+                try:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+                except BaseException:
+                    # Don't leave a partial scan behind
+                    os.unlink(f.name)
+                    raise
+        return Path(f.name)
+
     def download_scans(self):
         """
         Downloads all scan .bdio files for product-version, and collects them
@@ -134,38 +199,62 @@ class ReportsDownloader:
         """
 
         logger.info(f"Downloading .bdio scans")
-        output = self.hub.download_project_scans(
-            self.product_name, self.version_name,
-            str(self.output_dir)
-        )
+        codelocations = self.hub.get_version_codelocations(self.version)
+
+        urls = [
+            link['href']
+            for item in codelocations['items']
+            for link in item['_meta']['links']
+            if link['rel'] == 'enclosure'
+        ]
 
+        # Rather than HubInstance.download_project_scans(), which fetches
+        # the scans one at a time, download them concurrently. They're
+        # staged in a temporary directory under the output directory, which
+        # is removed along with anything left in it even if a download fails
         logger.debug(f"Creating {self.prefix}-bdio.zip")
-        with zipfile.ZipFile(self.output_dir / f"{self.prefix}-bdio.zip", "w") as z:
-            for entry in output:
-                # I think the API *meant* to use a tuple here, but instead
-                # they used a two-item set, so we have to guess which one is
-                # the filename
-                for filename in entry:
-                    path = Path(filename)
-                    if not path.is_absolute():
-                        continue
-                    logger.debug(f"Adding {path} to zip")
-                    z.write(path, arcname=path.name)
+        with tempfile.TemporaryDirectory(dir=self.output_dir) as staging_dir, \
+                zipfile.ZipFile(self.output_dir / f"{self.prefix}-bdio.zip", "w") as z, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(self.download_scan, url, staging_dir)
+                for url in urls
+            ]
+            try:
+                # Add the scans in the order Hub lists them rather than the
+                # order they arrive in, so the .zip is the same every time
+                for url, future in zip(urls, futures):
+                    filename = url.split("/")[6]
+                    path = future.result()
+                    logger.debug(f"Adding {filename} to zip")
+                    z.write(path, arcname=filename)
                     path.unlink()
+            except BaseException:
+                # Don't start any more downloads once one has failed
+                for future in futures:
+                    future.cancel()
+                raise
 
-        logger.info(f"Downloaded {len(output)} scans")
+        logger.info(f"Downloaded {len(urls)} scans")
 
     def download(self):
         """
-        Invokes each of the download steps in turn, and waits for completion
+        Invokes each of the download steps, and waits for completion
         """
 
-        self.start_reports()
-        self.start_notices()
+        # Requesting the reports and downloading the scans are independent,
+        # so do them concurrently; the scans then download while Hub is
+        # busy generating the reports
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            reports = executor.submit(self.start_reports)
+            notices = executor.submit(self.start_notices)
+            scans = executor.submit(self.download_scans)
 
-        self.download_scans()
-        self.download_report("CSV reports", self.reports_location)
-        self.download_report("Notices file", self.notices_location)
+            reports.result()
+            notices.result()
+            self.download_report("CSV reports", self.reports_location)
+            self.download_report("Notices file", self.notices_location)
+            scans.result()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -179,6 +268,8 @@ if __name__ == "__main__":
                         help='Path to Black Duck server credentials JSON file')
     parser.add_argument('--output-dir', required=True,
                         help='Output path to directory for scans and reports')
+    parser.add_argument('--report-timeout', type=int, default=1200,
+                        help='Seconds to wait for Hub to generate each report')
 
     args = parser.parse_args()
 
@@ -189,6 +280,7 @@ if __name__ == "__main__":
     downloader = ReportsDownloader(
         args.product, args.version, args.bld_num,
         args.credentials,
-        args.output_dir
+        args.output_dir,
+        args.report_timeout
     )
     downloader.download()
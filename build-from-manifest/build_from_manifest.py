@@ -4,12 +4,17 @@
 Program to generate build information along with a source tarball
 for building when any additional changes have happened for a given
 input build manifest
+
+Uses the lxml module (installable via 'pip') for handling manifests
+when it is available, otherwise Python's own xml.etree.ElementTree
 """
 
 import argparse
+import concurrent.futures
 import contextlib
 import gzip
 import json
+import operator
 import os
 import os.path
 import pathlib
@@ -17,13 +22,16 @@ import shutil
 import subprocess
 import sys
 import tarfile
+import tempfile
 import time
-import xml.etree.ElementTree as EleTree
 
 from datetime import datetime
-from pathlib import Path
-from subprocess import PIPE, STDOUT, run
-from typing import Union
+from subprocess import DEVNULL, PIPE, STDOUT
+
+try:
+    from lxml import etree as EleTree
+except ImportError:
+    import xml.etree.ElementTree as EleTree
 
 
 # Context manager for handling a given set of code/commands
@@ -39,10 +47,138 @@ def pushd(new_dir):
         os.chdir(old_dir)
 
 
+def find_git_files(top='', in_git=False):
+    """
+    Yields the path of each .git directory below top, along with every
+    file inside them.  Symlinks are followed, but .repo directories are
+    skipped.  Uses os.scandir() so entry types don't need to be stat()ed
+    separately, and builds paths relative to top (no './' prefix).
+    """
+
+    with os.scandir(top or '.') as entries:
+        for entry in entries:
+            path = entry.path if top else entry.name
+
+            if entry.is_dir():
+                if entry.name == '.repo':
+                    continue
+
+                if entry.name == '.git':
+                    yield path
+                    yield from find_git_files(path, True)
+                else:
+                    yield from find_git_files(path, in_git)
+            # Git (or repo) sometimes creates broken symlinks, like
+            # "shallow", and Python's tarfile module chokes on those;
+            # is_file() is False for them
+            elif in_git and entry.is_file():
+                yield path
+
+
+def run(*args, **kwargs):
+    """
+    Wrapper for subprocess.run() which by default gives the command no
+    stdin (nothing here is interactive) and skips closing all other file
+    descriptors in the child, which is safe as Python opens files and
+    pipes as non-inheritable anyway
+    """
+
+    kwargs.setdefault('stdin', DEVNULL)
+    kwargs.setdefault('close_fds', False)
+
+    return subprocess.run(*args, **kwargs)
+
+
 # Save current path for program
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
 
+# Lookups for the "build" project (relative to a manifest's root element)
+# and its VERSION annotation; each returns a list of matches.  With lxml
+# they're precompiled XPath objects, otherwise plain findall() calls
+BUILD_PROJECT_PATH = 'project[@name="build"]'
+VERSION_ANNOTATION_PATH = 'annotation[@name="VERSION"]'
+
+if hasattr(EleTree, 'XPath'):
+    BUILD_PROJECT = EleTree.XPath(BUILD_PROJECT_PATH)
+    VERSION_ANNOTATION = EleTree.XPath(VERSION_ANNOTATION_PATH)
+else:
+    BUILD_PROJECT = operator.methodcaller('findall', BUILD_PROJECT_PATH)
+    VERSION_ANNOTATION = operator.methodcaller('findall',
+                                               VERSION_ANNOTATION_PATH)
+
+
+# Buffer size for copying file contents into the source tarball; tarfile's
+# own 16 KiB buffer means a great many tiny reads and writes for a large
+# repo sync
+TAR_COPY_BUFSIZE = 2 * 1024 * 1024
+
+
+def tar_copyfileobj(src, dst, length=None, exception=OSError, bufsize=None):
+    """
+    Drop-in replacement for tarfile.copyfileobj() which always uses
+    TAR_COPY_BUFSIZE (the bufsize argument only exists in newer Pythons)
+    """
+
+    if length == 0:
+        return
+
+    if length is None:
+        shutil.copyfileobj(src, dst, TAR_COPY_BUFSIZE)
+        return
+
+    blocks, remainder = divmod(length, TAR_COPY_BUFSIZE)
+
+    for size in [TAR_COPY_BUFSIZE] * blocks + [remainder]:
+        if size == 0:
+            continue
+
+        buf = src.read(size)
+
+        if len(buf) < size:
+            raise exception('unexpected end of data')
+
+        dst.write(buf)
+
+
+tarfile.copyfileobj = tar_copyfileobj
+
+
+@contextlib.contextmanager
+def gzip_writer(filename):
+    """
+    Yields a binary stream whose contents are gzip-compressed into
+    filename.  Uses pigz where available, which compresses on all cores
+    rather than just one; otherwise falls back to Python's gzip module.
+    """
+
+    pigz = shutil.which('pigz')
+
+    with open(filename, 'wb') as f_out:
+        if pigz is None:
+            # Level 6 matches gzip's (and pigz's) default; Python's own
+            # default of 9 is far slower for very little gain
+            with gzip.GzipFile(fileobj=f_out, mode='wb',
+                               compresslevel=6) as gz:
+                yield gz
+
+            return
+
+        proc = subprocess.Popen(
+            [pigz, '-p', str(os.cpu_count() or 1), '-c'],
+            stdin=PIPE, stdout=f_out, close_fds=False
+        )
+
+        try:
+            yield proc.stdin
+        finally:
+            proc.stdin.close()
+            proc.wait()
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
 class ManifestBuilder:
     """
     Handle creating a new manifest from a given input manifest,
@@ -54,7 +190,6 @@ class ManifestBuilder:
         'build.properties',
         'build-properties.json',
         'build-manifest.xml',
-        'source.tar',
         'source.tar.gz',
         'CHANGELOG'
     ]
@@ -90,6 +225,8 @@ class ManifestBuilder:
         self.build_job = None
         self.platforms = None
         self.build_manifest_filename = None
+        self.revision_manifest = None
+        self.revision_manifest_proc = None
         self.branch_exists = 0
         self.version = None
         self.release = None
@@ -106,8 +243,10 @@ class ManifestBuilder:
         for name in self.output_filenames:
             output_file = pathlib.Path(name).resolve()
 
-            if output_file.exists():
-                output_file.unlink()
+            try:
+                os.unlink(output_file)
+            except FileNotFoundError:
+                pass
 
             self.output_files[name] = output_file
 
@@ -123,14 +262,14 @@ class ManifestBuilder:
 
     def parse_manifest(self):
         """
-        Parse the input manifest (via xml.ElementTree)
+        Parse the input manifest (via lxml or xml.etree.ElementTree)
         """
 
         if not self.manifest.exists():
             print(f'Manifest "{self.manifest}" does not exist!')
             sys.exit(3)
 
-        self.input_manifest = EleTree.parse(self.manifest)
+        self.input_manifest = EleTree.parse(str(self.manifest))
 
     def determine_product_path(self):
         """
@@ -224,15 +363,19 @@ class ManifestBuilder:
             print('"module_projects" is set, calling update_manifest_from_submodules...')
             # https://code-maven.com/python-capture-stdout-stderr-exit
             # Do the following so the output from the sub-script's stderr
-            # and stdout aren't all out of order.
+            # and stdout aren't all out of order.  Pass it on a line at a
+            # time, so it shows up in the log as the sub-script runs.
             proc = subprocess.Popen(
                 [f'{script_dir}/update_manifest_from_submodules',
                  f'../manifest/{self.manifest}']
-                + module_projects, stdout=PIPE, stderr=STDOUT
+                + module_projects, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT,
+                close_fds=False, encoding='UTF-8', bufsize=1
             )
-            print(proc.communicate()[0].decode('UTF-8'))
+            for line in proc.stdout:
+                print(line, end='', flush=True)
+            proc.wait()
             if proc.returncode != 0:
-                print("\n\nError {proc.returncode} running update_manifest_from_submodules!")
+                print(f"\n\nError {proc.returncode} running update_manifest_from_submodules!")
                 sys.exit(5)
 
             with pushd(module_projects_dir.parent / 'manifest'):
@@ -247,11 +390,12 @@ class ManifestBuilder:
                         print(f'Pushing updated input manifest upstream... '
                               f'return code was {rc}')
                         run([
-                            'git', 'commit', '-am', f'Automated update of '
+                            'git', '-c', 'gc.auto=0', 'commit', '--quiet',
+                            '--no-verify', '-am', f'Automated update of '
                             f'{self.product} from submodules'
                         ], check=True)
                         run([
-                            'git', 'push',
+                            'git', 'push', '--quiet', '--no-verify',
                             self.push_manifest_project,
                             'refs/heads/master:refs/heads/master'
                         ], check=True)
@@ -289,16 +433,16 @@ class ManifestBuilder:
         namely version and release
         """
 
-        build_element = self.input_manifest.find('./project[@name="build"]')
+        build_elements = BUILD_PROJECT(self.input_manifest.getroot())
 
-        if build_element is None:
+        if not build_elements:
             print(f'Input manifest {self.manifest} has no "build" project!')
             sys.exit(4)
 
-        vers_annot = build_element.find('annotation[@name="VERSION"]')
+        vers_annots = VERSION_ANNOTATION(build_elements[0])
 
-        if vers_annot is not None:
-            self.version = vers_annot.get('value')
+        if vers_annots:
+            self.version = vers_annots[0].get('value')
             print(f'Input manifest version: {self.version}')
         else:
             self.version = '0.0.0'
@@ -319,52 +463,100 @@ class ManifestBuilder:
 
         with pushd(product_dir):
             top_level = [
-                f for f in pathlib.Path().iterdir() if str(f) != '.repo'
+                str(f) for f in pathlib.Path().iterdir() if str(f) != '.repo'
             ]
 
-            child: Union[str, Path]
-            for child in top_level:
-                shutil.rmtree(child) if child.is_dir() else child.unlink()
+            # A full checkout can hold a very large number of files, which
+            # 'rm -rf' removes a good deal faster than shutil.rmtree()
+            if top_level:
+                run(['rm', '-rf', '--'] + top_level, check=True)
 
             run(['repo', 'init', '-u', str(top_dir / 'manifest'), '-g', 'all',
                  '-m', str(self.manifest)], check=True)
-            run(['repo', 'sync', '--jobs=6', '--force-sync'], check=True)
+            # Fetching is mostly network-bound, so run more jobs than
+            # there are cores
+            jobs = min(32, (os.cpu_count() or 4) * 4)
+            run(['repo', 'sync', f'--jobs={jobs}', '--no-clone-bundle',
+                 '--force-sync'], check=True)
 
-    def update_bm_repo_and_get_build_num(self):
+    def update_bm_repo(self, bm_dir):
         """
-        Update the build-manifests repository checkout, then
-        determine the next build number to use
+        Update the build-manifests repository checkout, cloning it
+        first if needed.  This runs in the background while the main
+        thread changes directory, so bm_dir must be an absolute path
+        and commands are run with an explicit cwd rather than pushd
         """
 
-        bm_dir = pathlib.Path('build-manifests')
-
+        # Only the tip of master is needed to find the last build number
+        # and commit the new build manifest on top, so there's no need
+        # to download the (ever-growing) history
         if not bm_dir.is_dir():
-            run(['git', 'clone', f'ssh://git@github.com/'
-                 f'{self.build_manifests_org}/build-manifests'],
-                check=True)
+            run(['git', 'clone', '--depth=1', '--single-branch',
+                 f'ssh://git@github.com/'
+                 f'{self.build_manifests_org}/build-manifests',
+                 str(bm_dir)], check=True)
+
+        print('Updating the build-manifests repository...')
+        run(['git', 'fetch', '--all'], check=True, cwd=str(bm_dir))
+        run(['git', 'reset', '--hard', 'origin/master'], check=True,
+            cwd=str(bm_dir))
 
-        with pushd(bm_dir):
-            print('Updating the build-manifests repository...')
-            run(['git', 'fetch', '--all'], check=True)
-            run(['git', 'reset', '--hard', 'origin/master'], check=True)
+    def get_build_num(self):
+        """
+        Determine the next build number to use from the updated
+        build-manifests repository
+        """
 
+        with pushd('build-manifests'):
             self.build_manifest_filename = pathlib.Path(
                 f'{self.product_path}/{self.release}/{self.version}.xml'
             ).resolve()
 
             if self.build_manifest_filename.exists():
-                last_build_manifest = EleTree.parse(
-                    self.build_manifest_filename
-                )
-                last_bld_num_annot = last_build_manifest.find(
-                    './project[@name="build"]/annotation[@name="BLD_NUM"]'
-                )
+                # Only the BLD_NUM annotation of the top-level "build"
+                # project is needed, so stream-parse the manifest and stop
+                # as soon as that project has been seen, rather than
+                # building the whole tree
+                depth = 0
+                in_build = False
+
+                for event, elem in EleTree.iterparse(
+                        str(self.build_manifest_filename),
+                        events=('start', 'end')):
+                    if event == 'start':
+                        depth += 1
+
+                        if depth == 2 and elem.tag == 'project':
+                            in_build = elem.get('name') == 'build'
+                        elif (depth == 3 and in_build
+                                and elem.tag == 'annotation'
+                                and elem.get('name') == 'BLD_NUM'):
+                            self.last_build_num = int(elem.get('value'))
+                            break
+                    else:
+                        depth -= 1
 
-                if last_bld_num_annot is not None:
-                    self.last_build_num = int(last_bld_num_annot.get('value'))
+                        if depth == 1:
+                            if in_build:
+                                break
+
+                            elem.clear()
 
             self.build_num = max(self.last_build_num + 1, self.start_build)
 
+    def start_revision_manifest(self):
+        """
+        Start 'repo manifest -r' in the background, capturing its output
+        in a temporary file; it doesn't depend on the CHANGELOG, so it
+        can run while that is being generated
+        """
+
+        self.revision_manifest = tempfile.TemporaryFile()
+        self.revision_manifest_proc = subprocess.Popen(
+            ['repo', 'manifest', '-r'], stdin=DEVNULL,
+            stdout=self.revision_manifest, close_fds=False
+        )
+
     def generate_changelog(self):
         """
         Generate the CHANGELOG file from any changes that have been
@@ -405,12 +597,9 @@ class ManifestBuilder:
             print('Saving CHANGELOG...')
             # Need to re-run 'repo diffmanifests' without '--raw'
             # to get pretty output
-            output = run(['repo', 'diffmanifests',
-                          self.build_manifest_filename],
-                         check=True, stdout=PIPE).stdout
-
             with open(self.output_files['CHANGELOG'], 'wb') as fh:
-                fh.write(output)
+                run(['repo', 'diffmanifests', self.build_manifest_filename],
+                    check=True, stdout=fh)
 
     def update_build_manifest_annotations(self):
         """
@@ -433,12 +622,16 @@ class ManifestBuilder:
 
         print(f'Updating build manifest {self.build_manifest_filename}')
 
-        with open(self.build_manifest_filename, 'w') as fh:
-            run(['repo', 'manifest', '-r'], check=True, stdout=fh)
+        proc = self.revision_manifest_proc
 
-        last_build_manifest = EleTree.parse(self.build_manifest_filename)
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
-        build_element = last_build_manifest.find('./project[@name="build"]')
+        with self.revision_manifest as fh:
+            fh.seek(0)
+            last_build_manifest = EleTree.parse(fh)
+
+        build_element = BUILD_PROJECT(last_build_manifest.getroot())[0]
         insert_child_annot(build_element, 'BLD_NUM', str(self.build_num))
         insert_child_annot(build_element, 'PRODUCT', self.product)
         insert_child_annot(build_element, 'RELEASE', self.release)
@@ -446,19 +639,16 @@ class ManifestBuilder:
         if self.go_version is not None:
             insert_child_annot(build_element, 'GO_VERSION', self.go_version)
 
-        version_annot = last_build_manifest.find(
-            './project[@name="build"]/annotation[@name="VERSION"]'
-        )
-
-        if version_annot is None:
+        if not VERSION_ANNOTATION(build_element):
             insert_child_annot(build_element, 'VERSION', self.version)
 
-        last_build_manifest.write(self.build_manifest_filename)
+        last_build_manifest.write(str(self.build_manifest_filename))
+
+        now = datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+        tz = time.tzname[time.localtime().tm_isdst]
 
         return (f"{self.product} {self.release} build {self.version}-"
-                f"{self.build_num}\n\n"
-                f"{datetime.now().strftime('%Y/%m/%d %H:%M:%S')} "
-                f"{time.tzname[time.localtime().tm_isdst]}")
+                f"{self.build_num}\n\n{now} {tz}")
 
     def push_manifest(self, commit_msg):
         """
@@ -466,13 +656,16 @@ class ManifestBuilder:
         repository, but only if it hasn't been disallowed
         """
 
+        # These are automated commits, so skip any hooks and don't
+        # let git decide to run a gc in the middle of the build
         with pushd('build-manifests'):
             run(['git', 'add', self.build_manifest_filename], check=True)
-            run(['git', 'commit', '-m', commit_msg], check=True)
+            run(['git', '-c', 'gc.auto=0', 'commit', '--quiet', '--no-verify',
+                 '-m', commit_msg], check=True)
 
             if self.push:
-                run(['git', 'push', 'origin', f'HEAD:refs/heads/master'],
-                    check=True)
+                run(['git', 'push', '--quiet', '--no-verify', 'origin',
+                     f'HEAD:refs/heads/master'], check=True)
             else:
                 print('Skipping push of new build manifest due to --no-push')
 
@@ -513,8 +706,10 @@ class ManifestBuilder:
             'FORCE': self.force
         }
 
+        # json.dump() issues a write() for every token it encodes, so
+        # build the whole document first and write it out at once
         with open(self.output_files['build-properties.json'], 'w') as fh:
-            json.dump(properties, fh, indent=2, separators=(',', ': '))
+            fh.write(json.dumps(properties, indent=2, separators=(',', ': ')))
 
         with open(self.output_files['build.properties'], 'w') as fh:
             plats = ' '.join(self.platforms)
@@ -540,56 +735,41 @@ class ManifestBuilder:
         information, and only copy the .git directory if specified.
         """
 
-        tarball_filename = self.output_files['source.tar']
         targz_filename = self.output_files['source.tar.gz']
 
-        print(f'Creating {tarball_filename}')
+        print(f'Creating {targz_filename}')
         product_dir = pathlib.Path(self.product_path)
 
-        with pushd(product_dir):
-            with tarfile.open(tarball_filename, 'w') as tar_fh:
-                for root, dirs, files in os.walk('.'):
-                    for name in files:
-                        tar_fh.add(os.path.join(root, name)[2:])
-                    for name in dirs:
-                        if name == '.repo' or name == '.git':
-                            dirs.remove(name)
-                        else:
-                            tar_fh.add(os.path.join(root, name)[2:],
-                                       recursive=False)
-
-            if self.manifest_config.get('keep_git', False):
-                print(f'Adding Git files to {tarball_filename}')
-                # When keeping git files, need to dereference symlinks
-                # so that the resulting .git directories work on Windows.
-                # Because of this, we don't save the .repo directory
-                # also, as that would double the size of the tarball
-                # since mostly .repo just contains git dirs.
-                with tarfile.open(tarball_filename, "a",
-                                  dereference=True) as tar:
-                    for root, dirs, files in os.walk('.', followlinks=True):
-                        for name in dirs:
-                            if name == '.repo':
-                                dirs.remove(name)
-                            elif name == '.git':
-                                tar.add(os.path.join(root, name)[2:],
-                                        recursive=False)
-                        if '/.git' in root:
-                            for name in files:
-                                # Git (or repo) sometimes creates broken
-                                # symlinks, like "shallow", and Python's
-                                # tarfile module chokes on those
-                                if os.path.exists(os.path.join(root, name)):
-                                    tar.add(os.path.join(root, name)[2:],
-                                            recursive=False)
-
-        print(f'Compressing {tarball_filename}')
-
-        with open(tarball_filename, 'rb') as f_in, \
-                gzip.open(targz_filename, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-
-        os.unlink(tarball_filename)
+        def exclude_repo_metadata(tarinfo):
+            # Skip .repo and .git directories (or symlinks to them), but
+            # keep any regular files which happen to be named .git
+            if os.path.basename(tarinfo.name) in ('.repo', '.git') \
+                    and not tarinfo.isfile():
+                return None
+
+            return tarinfo
+
+        # Stream the tar straight into the compressor, so the uncompressed
+        # tarball is never written out and read back in again
+        with gzip_writer(targz_filename) as f_out, pushd(product_dir):
+            with tarfile.open(fileobj=f_out, mode='w|',
+                              bufsize=TAR_COPY_BUFSIZE) as tar_fh:
+                for name in sorted(os.listdir('.')):
+                    tar_fh.add(name, filter=exclude_repo_metadata)
+
+                if self.manifest_config.get('keep_git', False):
+                    print(f'Adding Git files to {targz_filename}')
+                    # When keeping git files, need to dereference symlinks
+                    # so that the resulting .git directories work on Windows.
+                    # Because of this, we don't save the .repo directory
+                    # also, as that would double the size of the tarball
+                    # since mostly .repo just contains git dirs.  This
+                    # only affects entries added from here on, so the
+                    # tarball can be written in a single pass.
+                    tar_fh.dereference = True
+
+                    for path in find_git_files():
+                        tar_fh.add(path, recursive=False)
 
     def generate_final_files(self):
         """
@@ -609,14 +789,16 @@ class ManifestBuilder:
         from a high-level overview.  Summary:
 
           - Prepare for various key files, removing any old ones
+          - Start updating the build-manifests repository in the
+            background
           - Determine the product information from the config files
           - Setup manifest repository and determine build information
             from it
           - If there are submodules, ensure they're updated
           - Set the relevant and necessary paramaters (e.g. version)
           - Do a repo sync based on the given manifest
-          - Update the build-manifests repository and determine
-            the next build number to use
+          - Wait for the build-manifests repository update, then
+            determine the next build number to use
           - Generate the CHANGELOG and update the build manifest
             annotations
           - Push the generated manifest to build-manifests, if
@@ -626,19 +808,38 @@ class ManifestBuilder:
         """
 
         self.prepare_files()
-        self.do_manifest_stuff()
 
-        module_projects = self.manifest_config.get('module_projects')
-        if module_projects is not None:
-            self.update_submodules(module_projects)
+        # The build-manifests repository is independent of everything
+        # up to the repo sync, so update it at the same time
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            bm_update = executor.submit(
+                self.update_bm_repo, pathlib.Path('build-manifests').resolve()
+            )
+
+            self.do_manifest_stuff()
 
-        self.set_relevant_parameters()
-        self.set_build_parameters()
-        self.perform_repo_sync()
-        self.update_bm_repo_and_get_build_num()
+            module_projects = self.manifest_config.get('module_projects')
+            if module_projects is not None:
+                self.update_submodules(module_projects)
+
+            self.set_relevant_parameters()
+            self.set_build_parameters()
+            self.perform_repo_sync()
+            bm_update.result()
+
+        self.get_build_num()
 
         with pushd(self.product_path):
-            self.generate_changelog()
+            self.start_revision_manifest()
+
+            try:
+                self.generate_changelog()
+            except BaseException:
+                # Including the sys.exit() when there are no changes
+                self.revision_manifest_proc.kill()
+                self.revision_manifest_proc.wait()
+                raise
+
             commit_msg = self.update_build_manifest_annotations()
 
         self.push_manifest(commit_msg)